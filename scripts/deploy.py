@@ -1,20 +1,39 @@
 import argparse
 import hashlib
-import json
 import os
+import random
 import sys
 import time
-import urllib.error
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from itertools import takewhile
 from typing import Any, Dict, Optional, Tuple
 
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from payload_io import dumps_json, load_payload
+
 DEFAULT_TIMEOUT_SECONDS = 30
 DEFAULT_POLL_SECONDS = 10
+DEFAULT_POLL_MAX_SECONDS = 120
+DEFAULT_LONG_POLL_SECONDS = 0  # 0 = server doesn't support long-poll
 DEFAULT_MAX_WAIT_SECONDS = 60 * 60  # 1 hour
 DEFAULT_MAX_RETRIES = 6
 
+NS_PER_SECOND = 1_000_000_000
+
 RETRYABLE_HTTP = {429, 500, 502, 503, 504}
 
+# Normalize states you might return
+SUCCEEDED_STATES = {"succeeded", "success", "completed"}
+FAILED_STATES = {"failed", "error", "cancelled", "canceled"}
+
+# Submit + status polls all go to one host; a small pool is plenty.
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 8
+
 def _redact(s: str) -> str:
     if not s:
         return s
@@ -22,65 +41,135 @@ def _redact(s: str) -> str:
         return "****"
     return s[:4] + "****" + s[-4:]
 
-def _json_dumps(data: Any) -> bytes:
-    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+class _LoggingRetry(Retry):
+    """
+    urllib3 Retry that keeps the pipeline log's [warn] line for every retry it schedules.
+    """
+
+    def get_backoff_time(self) -> float:
+        # urllib3 2.x retries the first failure immediately; keep waiting 1, 2, 4, ... (x backoff_factor,
+        # capped at backoff_max) so a 429/503 without Retry-After still gets a breather.
+        errors = len(list(takewhile(lambda h: h.redirect_location is None, reversed(self.history))))
+        if errors == 0:
+            return 0
+        return min(self.backoff_max, self.backoff_factor * (2 ** (errors - 1)))
+
+    def get_retry_after(self, response) -> Optional[float]:
+        # Honour a server's Retry-After, but never sleep longer than backoff_max inside one request:
+        # an hour-long Retry-After would otherwise blow straight through --max-wait.
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, self.backoff_max)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        attempt = len(retry.history)
+        of = attempt + (retry.total or 0)
+        sleep = (response is not None and retry.get_retry_after(response)) or retry.get_backoff_time()
+        if response is not None:
+            print(f"[warn] HTTP {response.status} retryable. attempt={attempt}/{of} sleep={sleep:g}s")
+        else:
+            print(f"[warn] Network/timeout retry. attempt={attempt}/{of} sleep={sleep:g}s err={error}")
+        return retry
+
+def _make_session(default_headers: Dict[str, str], max_retries: int) -> requests.Session:
+    """
+    Session reused for submit + every status poll so the TCP/TLS connection is kept alive.
+    default_headers (auth, correlation id) are sent on every request without per-call merging.
+    Transient failures and RETRYABLE_HTTP codes are retried by the adapter with exponential
+    backoff, honouring Retry-After; every retry sleep is capped at 60s. POST is safe to retry thanks to Idempotency-Key.
+    Status JSON compresses well; requests decodes gzip/deflate bodies transparently.
+    """
+    retry = _LoggingRetry(
+        total=max_retries,
+        backoff_factor=1,
+        backoff_max=60,
+        status_forcelist=RETRYABLE_HTTP,
+        allowed_methods={"GET", "POST"},
+        respect_retry_after_header=True,
+        raise_on_status=False,  # hand the last error response back so _request can report its body
+    )
+    session = requests.Session()
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    session.headers.update(default_headers)
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 def _request(
+    session: requests.Session,
     method: str,
     url: str,
     headers: Dict[str, str],
     body: Optional[bytes],
     timeout: int,
-    max_retries: int,
-) -> Tuple[int, bytes]:
+) -> Tuple[int, bytes, bool]:
     """
-    Basic retry with exponential backoff for transient failures and retryable HTTP codes.
+    Single request through the session; retries already happened in its transport.
+    Returns (status, body, retried) where retried means the adapter had to retry (and back off).
     """
-    attempt = 0
-    last_err: Optional[Exception] = None
-
-    while attempt <= max_retries:
-        try:
-            req = urllib.request.Request(url=url, data=body, method=method)
-            for k, v in headers.items():
-                req.add_header(k, v)
-
-            with urllib.request.urlopen(req, timeout=timeout) as resp:
-                return resp.status, resp.read()
-
-        except urllib.error.HTTPError as e:
-            status = getattr(e, "code", None)
-            payload = e.read() if hasattr(e, "read") else b""
-            # Retry only if retryable
-            if status in RETRYABLE_HTTP and attempt < max_retries:
-                sleep = min(60, (2 ** attempt))  # 1,2,4,8,16,32... capped
-                print(f"[warn] HTTP {status} retryable. attempt={attempt+1}/{max_retries} sleep={sleep}s")
-                time.sleep(sleep)
-                attempt += 1
-                continue
-            # Non-retryable or out of retries
-            raise RuntimeError(f"HTTPError {status}: {payload.decode('utf-8', errors='replace')}") from e
-
-        except (urllib.error.URLError, TimeoutError) as e:
-            last_err = e
-            if attempt < max_retries:
-                sleep = min(60, (2 ** attempt))
-                print(f"[warn] Network/timeout retry. attempt={attempt+1}/{max_retries} sleep={sleep}s err={e}")
-                time.sleep(sleep)
-                attempt += 1
-                continue
-            break
-
-    raise RuntimeError(f"Request failed after retries: {last_err}") from last_err
+    try:
+        resp = session.request(method, url, headers=headers, data=body, timeout=timeout)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        raise RuntimeError(f"Request failed after retries: {e}") from e
+
+    status = resp.status_code
+    if status >= 400:
+        # Non-retryable or out of retries
+        raise RuntimeError(f"HTTPError {status}: {resp.content.decode('utf-8', errors='replace')}")
+    history = resp.raw.retries.history if resp.raw.retries else ()
+    retried = any(h.redirect_location is None for h in history)
+    return status, resp.content, retried
+
+def _poll_delay(base: int, ceiling: int, step: int) -> float:
+    """
+    Poll interval grows 1.5x per unchanged poll up to ceiling, with +/-20% jitter so
+    concurrent pipelines don't poll in lockstep.
+    """
+    return min(ceiling, base * (1.5 ** min(step, 8))) * random.uniform(0.8, 1.2)
 
-def _make_idempotency_key(payload: Dict[str, Any], salt: str) -> str:
-    raw = _json_dumps(payload) + salt.encode("utf-8")
-    return hashlib.sha256(raw).hexdigest()
+def _make_idempotency_key(payload_path: str, payload: Any, salt: str) -> str:
+    """
+    Hash the payload file's raw bytes rather than re-serializing the parsed payload.
+    Note: whitespace/key-order edits to the file therefore yield a different key.
+    A pipe or /dev/stdin was consumed by parsing and can't be re-read, so hash the payload instead.
+    """
+    if os.path.isfile(payload_path):
+        with open(payload_path, "rb") as f:
+            h = hashlib.file_digest(f, "sha256")
+    else:
+        h = hashlib.sha256(dumps_json(payload))
+    h.update(salt.encode("utf-8"))
+    return h.hexdigest()
 
 def _parse_json(b: bytes) -> Any:
     if not b:
         return {}
-    return json.loads(b.decode("utf-8"))
+    return orjson.loads(b)
+
+def _job_state(resp: Any) -> str:
+    return (resp.get("status") or resp.get("state") or "").lower()
+
+def _finish(job_id: str, state: str, payload: Dict[str, Any], submit_resp: Any, status_resp: Any) -> Optional[int]:
+    """
+    Report a terminal state and write artifacts. Returns the exit code, or None while the job is still in flight.
+    """
+    if state in SUCCEEDED_STATES:
+        rc, summary = 0, f"[info] Deployment SUCCEEDED for job {job_id}."
+    elif state in FAILED_STATES:
+        rc, summary = 5, f"[error] Deployment FAILED for job {job_id}. status_payload={status_resp}"
+    else:
+        return None
+
+    # Write the artifact on a worker while the (possibly large) summary is printed and flushed
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        write = pool.submit(_write_artifacts, job_id, payload, submit_resp, status_resp)
+        print(summary, flush=True)
+        path = write.result()
+    print(f"[info] Wrote artifact: {path}")
+    return rc
 
 def main() -> int:
     ap = argparse.ArgumentParser()
@@ -91,10 +180,15 @@ def main() -> int:
                     help="API key (prefer env var)")
     ap.add_argument("--timeout", type=int, default=int(os.getenv("DEPLOY_API_TIMEOUT", DEFAULT_TIMEOUT_SECONDS)))
     ap.add_argument("--poll", type=int, default=int(os.getenv("DEPLOY_API_POLL_SECONDS", DEFAULT_POLL_SECONDS)))
+    ap.add_argument("--poll-max", type=int, default=int(os.getenv("DEPLOY_API_POLL_MAX_SECONDS", DEFAULT_POLL_MAX_SECONDS)))
+    ap.add_argument("--long-poll", type=int, default=int(os.getenv("DEPLOY_API_LONG_POLL_SECONDS", DEFAULT_LONG_POLL_SECONDS)),
+                    help="Ask the status endpoint to hold each GET up to N seconds (Prefer: wait=N)")
     ap.add_argument("--max-wait", type=int, default=int(os.getenv("DEPLOY_API_MAX_WAIT", DEFAULT_MAX_WAIT_SECONDS)))
     ap.add_argument("--max-retries", type=int, default=int(os.getenv("DEPLOY_API_MAX_RETRIES", DEFAULT_MAX_RETRIES)))
     ap.add_argument("--submit-path", default=os.getenv("DEPLOY_API_SUBMIT_PATH", "/deployments"))
     ap.add_argument("--status-path-template", default=os.getenv("DEPLOY_API_STATUS_PATH_TEMPLATE", "/deployments/{jobId}"))
+    ap.add_argument("--schema", default=os.getenv("DEPLOY_SCHEMA_PATH", ""),
+                    help="Validate the payload against this JSON schema before submitting")
     ap.add_argument("--correlation-id", default=os.getenv("BUILD_BUILDID", "") or os.getenv("SYSTEM_JOBID", "") or "")
     args = ap.parse_args()
 
@@ -105,87 +199,114 @@ def main() -> int:
         print("Missing API key. Provide --api-key or set DEPLOY_API_KEY.")
         return 2
 
-    with open(args.payload, "r", encoding="utf-8") as f:
-        payload = json.load(f)
+    payload = load_payload(args.payload)
+
+    if args.schema:
+        # Imported lazily so deploys without --schema don't pay for loading jsonschema
+        from validate_payload import validate
+
+        ok, errors = validate(payload, args.schema)
+        if not ok:
+            print("[error] Payload schema validation FAILED:")
+            for msg in errors:
+                print(f"- {msg}")
+            return 2
+        print("[info] Payload schema validation OK.")
 
     # Idempotency key salt ties to this pipeline run & commit where possible
     salt = (os.getenv("BUILD_SOURCEVERSION", "") + "|" + os.getenv("BUILD_BUILDID", "") + "|" + args.base_url)
-    idem_key = _make_idempotency_key(payload, salt)
+    idem_key = _make_idempotency_key(args.payload, payload, salt)
 
-    submit_url = args.base_url.rstrip("/") + args.submit_path
+    base_url = args.base_url.rstrip("/")
+    submit_url = base_url + args.submit_path
 
-    headers = {
-        "Content-Type": "application/json",
+    # Sent on every request via the session
+    common_headers = {
         "Accept": "application/json",
         "X-API-Key": args.api_key,
-        "Idempotency-Key": idem_key,
     }
     if args.correlation_id:
-        headers["X-Correlation-Id"] = str(args.correlation_id)
+        common_headers["X-Correlation-Id"] = str(args.correlation_id)
+
+    submit_headers = {
+        "Content-Type": "application/json",
+        "Idempotency-Key": idem_key,
+    }
 
     print(f"[info] Submitting deployment to: {submit_url}")
     print(f"[info] Using Idempotency-Key: {idem_key[:8]}…")
     print(f"[info] Using API key: {_redact(args.api_key)}")
 
-    status, resp_bytes = _request(
-        method="POST",
-        url=submit_url,
-        headers=headers,
-        body=_json_dumps(payload),
-        timeout=args.timeout,
-        max_retries=args.max_retries,
-    )
-
-    resp = _parse_json(resp_bytes)
-    job_id = resp.get("jobId") or resp.get("id") or resp.get("deploymentId")
-    if not job_id:
-        print(f"[error] Submit response missing job id. status={status} resp={resp}")
-        return 3
-
-    print(f"[info] jobId={job_id}")
-
-    # Poll
-    status_url = args.base_url.rstrip("/") + args.status_path_template.format(jobId=job_id)
-    start = time.time()
-
-    while True:
-        elapsed = int(time.time() - start)
-        if elapsed > args.max_wait:
-            print(f"[error] Timed out waiting for job {job_id}. waited={elapsed}s")
-            return 4
-
-        s_status, s_bytes = _request(
-            method="GET",
-            url=status_url,
-            headers={
-                "Accept": "application/json",
-                "X-API-Key": args.api_key,
-                "X-Correlation-Id": headers.get("X-Correlation-Id", ""),
-            },
-            body=None,
+    with _make_session(common_headers, args.max_retries) as session:
+        status, resp_bytes, _ = _request(
+            session=session,
+            method="POST",
+            url=submit_url,
+            headers=submit_headers,
+            body=dumps_json(payload),
             timeout=args.timeout,
-            max_retries=args.max_retries,
         )
 
-        s_resp = _parse_json(s_bytes)
-        state = (s_resp.get("status") or s_resp.get("state") or "").lower()
-
-        # Normalize states you might return
-        if state in ("succeeded", "success", "completed"):
-            print(f"[info] Deployment SUCCEEDED for job {job_id}.")
-            _write_artifacts(job_id, payload, resp, s_resp)
-            return 0
-        if state in ("failed", "error", "cancelled", "canceled"):
-            print(f"[error] Deployment FAILED for job {job_id}. status_payload={s_resp}")
-            _write_artifacts(job_id, payload, resp, s_resp)
-            return 5
-
-        # still running / queued / unknown
-        msg = s_resp.get("message") or s_resp.get("summary") or ""
-        print(f"[info] job={job_id} state={state or 'unknown'} elapsed={elapsed}s {msg}".rstrip())
-        time.sleep(args.poll)
+        resp = _parse_json(resp_bytes)
+        job_id = resp.get("jobId") or resp.get("id") or resp.get("deploymentId")
+        if not job_id:
+            print(f"[error] Submit response missing job id. status={status} resp={resp}")
+            return 3
+
+        print(f"[info] jobId={job_id}")
+
+        # Poll
+        status_url = base_url + args.status_path_template.format(jobId=job_id)
+        start = time.monotonic_ns()  # immune to wall-clock (NTP) steps
+        poll_step = 0
+        last_state = None
+        # Built once and reused by every poll; the session supplies the common headers.
+        # A held long-poll GET must not trip the client-side read timeout.
+        poll_headers = {"Prefer": f"wait={args.long_poll}"} if args.long_poll else {}
+        poll_timeout = max(args.timeout, args.long_poll + 5) if args.long_poll else args.timeout
+
+        while True:
+            elapsed = (time.monotonic_ns() - start) // NS_PER_SECOND
+            if elapsed > args.max_wait:
+                print(f"[error] Timed out waiting for job {job_id}. waited={elapsed}s")
+                return 4
+
+            poll_start = time.monotonic_ns()
+            s_status, s_bytes, retried = _request(
+                session=session,
+                method="GET",
+                url=status_url,
+                headers=poll_headers,
+                body=None,
+                timeout=poll_timeout,
+            )
+            held_ns = time.monotonic_ns() - poll_start
+
+            s_resp = _parse_json(s_bytes)
+            state = _job_state(s_resp)
+            rc = _finish(job_id, state, payload, resp, s_resp)
+            if rc is not None:
+                return rc
+
+            # still running / queued / unknown
+            msg = s_resp.get("message") or s_resp.get("summary") or ""
+            print(f"[info] job={job_id} state={state or 'unknown'} elapsed={elapsed}s {msg}".rstrip())
+
+            # Back off while the state is unchanged; a transition means progress, so poll eagerly again
+            if state != last_state:
+                poll_step = 0
+                last_state = state
+            if args.long_poll and not retried and held_ns * 2 >= args.long_poll * NS_PER_SECOND:
+                # The server held the request until something changed (or its wait expired), so it
+                # already paced us. A quick return means long-poll isn't honoured: fall back to backoff.
+                # A slow answer that needed retries was spent in our own backoff after the server
+                # signalled trouble, not held; back off rather than re-polling straight away.
+                continue
+            delay = _poll_delay(args.poll, args.poll_max, poll_step)
+            poll_step += 1
+            time.sleep(min(delay, args.max_wait - elapsed + 1))
 
-def _write_artifacts(job_id: str, payload: Dict[str, Any], submit_resp: Any, status_resp: Any) -> None:
+def _write_artifacts(job_id: str, payload: Dict[str, Any], submit_resp: Any, status_resp: Any) -> str:
     out_dir = os.getenv("BUILD_ARTIFACTSTAGINGDIRECTORY", "artifacts")
     os.makedirs(out_dir, exist_ok=True)
 
@@ -197,10 +318,11 @@ def _write_artifacts(job_id: str, payload: Dict[str, Any], submit_resp: Any, sta
         "finalStatus": status_resp,
         "timestampUtc": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
     }
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
-
-    print(f"[info] Wrote artifact: {path}")
+    # Encode once to UTF-8 bytes and hand them to the OS in a single write
+    buf = dumps_json(data, indent=True)
+    with open(path, "wb") as f:
+        f.write(buf)
+    return path
 
 if __name__ == "__main__":
     sys.exit(main())
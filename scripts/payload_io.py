@@ -0,0 +1,30 @@
+import json
+from typing import Any
+
+import orjson
+
+class _NonFinite(float):
+    """
+    NaN/Infinity read from a payload. orjson would silently write these as null; it refuses float
+    subclasses instead, which sends dumps_json down the stdlib path that writes them back verbatim.
+    """
+
+def load_payload(path: str) -> Any:
+    """
+    Parse a payload file with stdlib json: it keeps integers of any size exact, accepts everything
+    the deploy has always accepted, and on payload-shaped input parses about as fast as orjson.
+    """
+    with open(path, "rb") as f:
+        return json.loads(f.read(), parse_constant=_NonFinite)
+
+def dumps_json(data: Any, indent: bool = False) -> bytes:
+    """
+    Encode with orjson (much faster than stdlib on the way out). Values orjson can't represent
+    exactly (ints beyond 64 bits, NaN/Infinity) raise TypeError there, so fall back to stdlib json.
+    """
+    try:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else None)
+    except TypeError:
+        if indent:
+            return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+        return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
@@ -1,31 +1,113 @@
 import argparse
-import json
+import functools
+import os
 import sys
+from typing import Any, List, Tuple
+from urllib.parse import unquote, urljoin, urlsplit
+
+import orjson
 from jsonschema import Draft202012Validator
+from jsonschema.exceptions import SchemaError
+from referencing import Registry, Resource
+from referencing.exceptions import NoSuchResource, Unresolvable
+from referencing.jsonschema import DRAFT202012
+
+from payload_io import load_payload
+
+@functools.lru_cache(maxsize=None)
+def _compile_validator(schema_path: str) -> Draft202012Validator:
+    """
+    Load the schema and build its validator once per process, however many payloads it checks.
+    """
+    with open(schema_path, "rb") as f:
+        schema = orjson.loads(f.read())
+    Draft202012Validator.check_schema(schema)
+
+    # Resolve relative $refs (e.g. "tags.json") lazily from files under the schema's directory, and only
+    # those: anything else is NoSuchResource, so jsonschema never fetches refs over the network
+    # (agents are air-gapped) and unrelated or broken *.json files next to the schema are never read.
+    root_id = Resource.from_contents(schema, default_specification=DRAFT202012).id()
+    base_uri = urljoin(root_id, ".") if root_id else ""
+    schema_dir = os.path.dirname(os.path.abspath(schema_path))
+
+    @functools.lru_cache(maxsize=None)
+    def retrieve(uri: str) -> Resource:
+        rel = urlsplit(uri[len(base_uri):]) if uri.startswith(base_uri) else None
+        if rel is None or rel.scheme or rel.netloc or rel.query:
+            raise NoSuchResource(ref=uri)
+        path = os.path.normpath(os.path.join(schema_dir, unquote(rel.path)))
+        if os.path.commonpath([schema_dir, path]) != schema_dir or not os.path.isfile(path):
+            raise NoSuchResource(ref=uri)
+        with open(path, "rb") as f:
+            contents = orjson.loads(f.read())
+        if not isinstance(contents, dict):
+            raise NoSuchResource(ref=uri)  # not a schema document
+        return Resource.from_contents(contents, default_specification=DRAFT202012)
+
+    registry = Registry(retrieve=retrieve)
+    return Draft202012Validator(schema, registry=registry, format_checker=None)
+
+def _payload_errors(v: Draft202012Validator, payload: Any) -> List[str]:
+    errors = sorted(v.iter_errors(payload), key=lambda e: e.path)
+    return [f"{'.'.join([str(p) for p in e.path]) or '(root)'}: {e.message}" for e in errors]
+
+def _schema_problem(schema_path: str, e: Exception) -> str:
+    if isinstance(e, SchemaError):
+        return f"Schema {schema_path} is invalid: {e.message}"
+    return f"Schema {schema_path} has an unresolvable $ref: {e.ref}"
+
+def validate(payload: Any, schema_path: str) -> Tuple[bool, List[str]]:
+    """
+    In-process entry point (used by deploy.py --schema). Reuses the cached validator for schema_path.
+    An invalid schema or unresolvable $ref is reported as a failure, worded as the CLI words it.
+    """
+    try:
+        errors = _payload_errors(_compile_validator(schema_path), payload)
+    except (SchemaError, Unresolvable) as e:
+        return False, [_schema_problem(schema_path, e)]
+    return not errors, errors
 
 def main() -> int:
     ap = argparse.ArgumentParser()
-    ap.add_argument("--payload", required=True)
+    ap.add_argument("--payload", required=True, nargs="+",
+                    help="One or more payload files; all are checked against one compiled schema")
     ap.add_argument("--schema", required=True)
     args = ap.parse_args()
 
-    with open(args.payload, "r", encoding="utf-8") as f:
-        payload = json.load(f)
+    try:
+        v = _compile_validator(args.schema)
+    except SchemaError as e:
+        print(_schema_problem(args.schema, e))
+        return 2
 
-    with open(args.schema, "r", encoding="utf-8") as f:
-        schema = json.load(f)
+    failed = 0
+    for payload_path in args.payload:
+        # A missing or malformed file fails on its own; the rest of the batch is still checked
+        try:
+            payload = load_payload(payload_path)
+        except (OSError, ValueError) as e:
+            failed += 1
+            print(f"Payload schema validation FAILED: {payload_path}\n")
+            print(f"- could not load payload: {e}\n")
+            continue
 
-    v = Draft202012Validator(schema)
-    errors = sorted(v.iter_errors(payload), key=lambda e: e.path)
+        try:
+            errors = _payload_errors(v, payload)
+        except Unresolvable as e:
+            print(_schema_problem(args.schema, e))
+            return 2
+        if errors:
+            failed += 1
+            print(f"Payload schema validation FAILED: {payload_path}\n")
+            for msg in errors:
+                print(f"- {msg}")
+            print()
+            continue
+        print(f"Payload schema validation OK: {payload_path}")
 
-    if errors:
-        print("Payload schema validation FAILED:\n")
-        for e in errors:
-            path = ".".join([str(p) for p in e.path]) or "(root)"
-            print(f"- {path}: {e.message}")
+    if failed:
+        print(f"{failed} of {len(args.payload)} payload(s) failed schema validation.")
         return 2
-
-    print("Payload schema validation OK.")
     return 0
 
 if __name__ == "__main__":